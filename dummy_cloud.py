@@ -1,57 +1,127 @@
-from datetime import datetime, timedelta
-from os import getenv
-import toml
+from collections import defaultdict
+from datetime import datetime
+from functools import lru_cache
+from os import getenv, stat, fstat
+from threading import Lock
+import tomllib
 from munch import Munch
-import requests
 from typing import (
+    Dict,
+    List,
+    Optional,
     Tuple,
     Union,
-    cast,
 )
 import logging
 from enum import Enum
-import json
+import re
 
-hour_timedelta = timedelta(hours=1)
+hour_seconds = 3600.0
+# naive datetimes are converted to seconds relative to a naive epoch, this keeps the
+# usage math identical to subtracting the naive datetimes (no DST shifts)
+naive_epoch = datetime(1970, 1, 1)
 dummy_file_env_var = "USAGE_EXPORTER_DUMMY_FILE"
+tenant_usage_url_pattern = re.compile(r"/os-simple-tenant-usage/([^?]+)\?(?:.*&)?start=([^&]*)")
+all_tenant_usages_url_pattern = re.compile(r"/os-simple-tenant-usage\?(?:.*&)?start=([^&]*)")
+server_detail_url_pattern = re.compile(r"/servers/detail\?all_tenants=\w+&project_id=([^&]*)")
+
+
+def naive_seconds(naive_datetime: datetime) -> float:
+    return (naive_datetime - naive_epoch).total_seconds()
+
+
+@lru_cache(maxsize=32)
+def parse_start_date(start_date: str) -> float:
+    # the exporter requests every project with the same start date
+    return naive_seconds(datetime.strptime(start_date, "%Y-%m-%dT%H:%M:%S.%f"))
+
+
+class DummyResponse:
+    """
+    Stand-in for the responses of the openstack compute client. The payload is handed out
+    as is instead of encoding it to json just to have it decoded by the caller again.
+    """
+
+    __slots__ = ("_payload",)
+
+    def __init__(self, payload):
+        self._payload = payload
+
+    def json(self):
+        return self._payload
 
 
 class DummyCloud:
 
     def __init__(self, dummy_file, start=None):
         self.dummy_file = dummy_file
-        self.dummy_values = toml.loads(self.dummy_file.read())
+        self.dummy_values = tomllib.loads(self.dummy_file.read())
+        # (path, st_mtime_ns) of the file the current dummy values were parsed from
+        self._cached_mtime = (None, fstat(self.dummy_file.fileno()).st_mtime_ns)
+        # projects and usages may be requested concurrently
+        self._load_lock = Lock()
         if start is not None:
             script_start = start.replace(tzinfo=None)
         else:
             script_start = datetime.now()
-        self.compute = Compute(self.dummy_values, script_start)
+        self.compute = Compute(self.dummy_values, script_start, self.load_toml)
+        self.index_projects()
 
     def load_toml(self):
+        """
+        Re-read the dummy file, but only if it has been modified since it has been parsed
+        the last time.
+        """
+        with self._load_lock:
+            self._load_toml()
+
+    def _load_toml(self):
         try:
-            with open(getenv(dummy_file_env_var)) as file:
-                file.seek(0)
-                self.dummy_values = toml.loads(file.read())
-                self.compute.reload(self.dummy_values)
+            path = getenv(dummy_file_env_var)
+            mtime = (path, stat(path).st_mtime_ns)
+            if mtime != self._cached_mtime:
+                with open(path) as file:
+                    self.reload(tomllib.loads(file.read()), mtime)
         except:
-            self.dummy_file.seek(0)
-            self.dummy_values = toml.loads(self.dummy_file.read())
-            self.compute.reload(self.dummy_values)
+            mtime = (None, fstat(self.dummy_file.fileno()).st_mtime_ns)
+            if mtime != self._cached_mtime:
+                self.dummy_file.seek(0)
+                self.reload(tomllib.loads(self.dummy_file.read()), mtime)
+
+    def reload(self, dummy_values, mtime):
+        self.dummy_values = dummy_values
+        self._cached_mtime = mtime
+        self.compute.reload(self.dummy_values)
+        self.index_projects()
+
+    def index_projects(self):
+        # built aside and assigned at once, projects may be listed meanwhile
+        projects: List[Munch] = []
+        projects_by_domain: Dict[str, List[Munch]] = defaultdict(list)
+        for domain_name, domain_content in self.dummy_values.items():
+            file_domain_id = domain_content.get("domain_id", "UNKNOWN_DOMAIN_ID")
+            for project_in_domain in domain_content.get("projects", []):
+                project = Munch(
+                    id=project_in_domain.get("project_id", "UNKNOWN_ID"),
+                    name=project_in_domain.get("project_name", "UNKNOWN_NAME"),
+                    domain_id=file_domain_id,
+                )
+                projects.append(project)
+                projects_by_domain[file_domain_id].append(project)
+        self._projects, self._projects_by_domain = projects, projects_by_domain
 
     def list_projects(self, domain_id=None):
         self.load_toml()
-        projects_return = []
-        for domain_name, domain_content in self.dummy_values.items():
-            if domain_id is not None and domain_content.get("domain_id", "UNKNOWN_DOMAIN_ID") != domain_id:
-                continue
-            projects_in_domain = domain_content.get("projects", [])
-            for project_in_domain in projects_in_domain:
-                project = Munch()
-                project.id = project_in_domain.get("project_id", "UNKNOWN_ID")
-                project.name = project_in_domain.get("project_name", "UNKNOWN_NAME")
-                project.domain_id = domain_content.get("domain_id", "UNKNOWN_DOMAIN_ID")
-                projects_return.append(project)
-        return projects_return
+        if domain_id is not None:
+            return list(self._projects_by_domain.get(domain_id, ()))
+        return list(self._projects)
+
+    def list_domains(self):
+        self.load_toml()
+        return [
+            Munch(id=domain_content.get("domain_id", "UNKNOWN_DOMAIN_ID"), name=domain_name)
+            for domain_name, domain_content in self.dummy_values.items()
+        ]
 
     def get_domain(self, name_or_id):
         self.load_toml()
@@ -87,6 +157,18 @@ class Compute:
         started both may lie in the future or past.
         """
 
+        __slots__ = (
+            "cpus",
+            "ram",
+            "ram_mb",
+            "existence",
+            "metadata",
+            "instance_id",
+            "started_at",
+            "existence_information",
+            "existence_hours",
+        )
+
         def __init__(self,
                      cpus: int = 4,
                      ram: int = 8,
@@ -95,12 +177,15 @@ class Compute:
                      instance_id="UNKNOWN_ID"):
             self.cpus = cpus
             self.ram = ram
+            self.ram_mb = ram * 1024
             self.existence = existence
             self.metadata = metadata
             self.instance_id = instance_id
             self.init_existence_information()
 
         def init_existence_information(self) -> None:
+            # formatted boot datetime, machines without one report the script start instead
+            self.started_at: Optional[str] = None
             if self.cpus <= 0 or self.ram <= 0:
                 raise ValueError("`cpu` and `ram` must be positive")
             if isinstance(self.existence, (list, tuple)):
@@ -108,147 +193,150 @@ class Compute:
                     raise ValueError(
                         "First existence-tuple datetime must be older than second one"
                     )
-                # remove any timezone information
                 self.existence_information = ExistenceInformation.BETWEEN_DATETIMES
+                # remove any timezone information
+                boot_datetime = self.existence[0].replace(tzinfo=None)
+                boot = naive_seconds(boot_datetime)
+                shutdown = naive_seconds(self.existence[1].replace(tzinfo=None))
+                self.started_at = boot_datetime.strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+                def existence_hours(requested_start, script_start, now):
+                    if boot > now:
+                        # machine did not boot yet
+                        return 0.0
+                    elif shutdown < now:
+                        # machine did run already and is considered down
+                        return (shutdown - max(requested_start, boot)) / hour_seconds
+                    # machine booted in the past but is still existing
+                    return (now - max(requested_start, boot)) / hour_seconds
             elif isinstance(self.existence, datetime):
                 self.existence_information = ExistenceInformation.SINCE_DATETIME
+                # remove any timezone information
+                boot_datetime = self.existence.replace(tzinfo=None)
+                boot = naive_seconds(boot_datetime)
+                self.started_at = boot_datetime.strftime("%Y-%m-%dT%H:%M:%S.%f")
+
+                def existence_hours(requested_start, script_start, now):
+                    # do not report negative usage in case the machine is not *booted yet*
+                    return max((now - max(requested_start, boot)) / hour_seconds, 0.0)
             elif isinstance(self.existence, bool):
-                self.existence_information = (
-                    ExistenceInformation.SINCE_SCRIPT_START
-                    if self.existence
-                    else ExistenceInformation.NO_EXISTENCE
-                )
+                if self.existence:
+                    self.existence_information = ExistenceInformation.SINCE_SCRIPT_START
+
+                    def existence_hours(requested_start, script_start, now):
+                        return (now - max(requested_start, script_start)) / hour_seconds
+                else:
+                    self.existence_information = ExistenceInformation.NO_EXISTENCE
+
+                    def existence_hours(requested_start, script_start, now):
+                        return 0.0
             else:
                 raise ValueError(
                     f"Invalid type for param `existence` (got {type(self.existence)}"
                 )
+            # the existence does not change, so the branch is only taken once
+            self.existence_hours = existence_hours
 
-        @property
-        def ram_mb(self) -> int:
-            return self.ram * 1024
-
-        def compute_server_info(self, requested_start_date, script_start) -> Munch:
-            requested_start_date = datetime.strptime(requested_start_date, "%Y-%m-%dT%H:%M:%S.%f")
-            now = datetime.now()
-            return_dict = Munch()
-            return_dict.hours = 0.0
-            return_dict.vcpus = self.cpus
-            return_dict.memory_mb = self.ram_mb
-            return_dict.started_at = script_start.strftime("%Y-%m-%dT%H:%M:%S.%f")
-            return_dict.instance_id = self.instance_id
-            if self.existence_information is ExistenceInformation.SINCE_SCRIPT_START:
-                if requested_start_date > script_start:
-                    hours_existence = (datetime.now() - requested_start_date) / hour_timedelta
-                else:
-                    hours_existence = (datetime.now() - script_start) / hour_timedelta
-                return_dict.hours = hours_existence
-            elif self.existence_information is ExistenceInformation.NO_EXISTENCE:
-                return return_dict
-            elif self.existence_information is ExistenceInformation.SINCE_DATETIME:
-                # to satisfy `mypy` type checker
-                boot_datetime = cast(datetime, self.existence)
-                if requested_start_date > boot_datetime:
-                    hours_existence = (datetime.now() - requested_start_date) / hour_timedelta
-                else:
-                    hours_existence = (now - boot_datetime.replace(tzinfo=None)) / hour_timedelta
-
-                # do not report negative usage in case the machine is not *booted yet*
-                return_dict.started_at = boot_datetime.strftime("%Y-%m-%dT%H:%M:%S.%f")
-                if hours_existence > 0:
-                    return_dict.hours = hours_existence
-            else:
-                # to satisfy `mypy` type checker
-                runtime_tuple = cast(Tuple[datetime, datetime], self.existence)
-                boot_datetime = cast(datetime, runtime_tuple[0].replace(tzinfo=None))
-                shutdown_datetime = cast(datetime, runtime_tuple[1].replace(tzinfo=None))
-                return_dict.started_at = boot_datetime.strftime("%Y-%m-%dT%H:%M:%S.%f")
-                if boot_datetime > now:
-                    # machine did not boot yet
-                    hours_existence = 0.0
-                elif shutdown_datetime < now:
-                    # machine did run already and is considered down
-                    if requested_start_date > boot_datetime:
-                        hours_existence = (shutdown_datetime - requested_start_date) / hour_timedelta
-                    else:
-                        hours_existence = (shutdown_datetime - boot_datetime) / hour_timedelta
-                else:
-                    # machine booted in the past but is still existing
-                    if requested_start_date > boot_datetime:
-                        hours_existence = (now - requested_start_date) / hour_timedelta
-                    else:
-                        hours_existence = (now - boot_datetime) / hour_timedelta
-                return_dict.hours = hours_existence
-            return return_dict
+        def compute_server_info(self, requested_start: float, script_start: float, now: float,
+                                script_started_at: str) -> dict:
+            """
+            All points in time are passed as seconds, see :func:`naive_seconds`.
+            """
+            return {
+                "hours": self.existence_hours(requested_start, script_start, now),
+                "vcpus": self.cpus,
+                "memory_mb": self.ram_mb,
+                "started_at": self.started_at or script_started_at,
+                "instance_id": self.instance_id,
+            }
 
         def get_details(self):
             return {"id": self.instance_id, "metadata": self.metadata}
 
-    def __init__(self, dummy_values, script_start):
-        self.dummy_values = dummy_values
-        self.os_simple_tenant_usage_string = "/os-simple-tenant-usage/"
-        self.server_detail_all_tenants_string = "/servers/detail?all_tenants=false&project_id="
+    def __init__(self, dummy_values, script_start, load_toml=None):
         self.script_start = script_start
+        # projects are cached by the exporter, so usage requests have to pick up
+        # modifications of the dummy file as well
+        self.load_toml = load_toml
+        self.script_start_seconds = naive_seconds(script_start)
+        self.script_started_at = script_start.strftime("%Y-%m-%dT%H:%M:%S.%f")
+        self.reload(dummy_values)
 
     def reload(self, dummy_values):
         self.dummy_values = dummy_values
+        # the machines only change with the dummy values, build them once per reload
+        # instead of on every request. The index is built aside and assigned at once,
+        # requests may be answered meanwhile
+        project_machines: Dict[str, List[Compute.DummyMachine]] = {}
+        for domain_name, domain_content in self.dummy_values.items():
+            for project_in_domain in domain_content.get("projects", []):
+                project_id = project_in_domain.get("project_id", "UNKNOWN_ID")
+                if project_id in project_machines:
+                    continue
+                project_machines[project_id] = [
+                    self.DummyMachine(toml_machine.get("cpus", 4), toml_machine.get("ram", 8),
+                                      toml_machine.get("existence", True), toml_machine.get("metadata", {}),
+                                      toml_machine.get("instance_id", "UNKNOWN_ID"))
+                    for toml_machine in project_in_domain.get("machines", [])
+                ]
+        self._project_machines = project_machines
 
-    def get_tenant_usage(self, project, requested_start_date):
+    def get_tenant_usage(self, project_id, machines, requested_start_date):
         server_usages = []
         start = requested_start_date
+        # one timestamp for all machines so they are consistent within a single request
         stop = datetime.now()
+        requested_start = parse_start_date(requested_start_date)
+        now = naive_seconds(stop)
 
-        for toml_machine in project.get("machines", []):
-            machine = self.DummyMachine(toml_machine.get("cpus", 4), toml_machine.get("ram", 8),
-                                        toml_machine.get("existence", True), toml_machine.get("metadata", {}),
-                                        toml_machine.get("instance_id", "UNKNOWN_ID"))
-            usage_temp = machine.compute_server_info(requested_start_date, self.script_start)
+        for machine in machines:
+            usage_temp = machine.compute_server_info(requested_start, self.script_start_seconds, now=now,
+                                                     script_started_at=self.script_started_at)
             server_usages.append(usage_temp)
 
         return {
             "tenant_usage": {
-                "tenant_id": project.get("project_id", "UNKNOWN_ID"),
+                "tenant_id": project_id,
                 "server_usages": server_usages,
                 "start": start,
-                "stop": stop
+                "stop": str(stop)
             }
         }
 
-    def get_server_details(self, project):
+    def get_all_tenant_usages(self, requested_start_date):
+        return {
+            "tenant_usages": [
+                self.get_tenant_usage(project_id, machines, requested_start_date)["tenant_usage"]
+                for project_id, machines in self._project_machines.items()
+            ]
+        }
+
+    def get_server_details(self, machines):
         servers = []
-        for toml_machine in project.get("machines", []):
-            machine = self.DummyMachine(toml_machine.get("cpus", 4), toml_machine.get("ram", 8),
-                                        toml_machine.get("existence", True), toml_machine.get("metadata", {}),
-                                        toml_machine.get("instance_id", "UNKNOWN_ID"))
+        for machine in machines:
             temp_dict = machine.get_details()
             servers.append(temp_dict)
         return {"servers": servers}
 
-    def get(self, url):
+    def get(self, url, **kwargs):
         if not isinstance(url, str):
             raise TypeError
-        if self.os_simple_tenant_usage_string in url:
-            request = url.split(self.os_simple_tenant_usage_string, 1)[1]
-            requested_project_id = request.split("?", 1)[0]
-            requested_start_date = request.split("start=", 1)[1]
-            for domain_name, domain_content in self.dummy_values.items():
-                projects_in_domain = domain_content.get("projects", [])
-                for project_in_domain in projects_in_domain:
-                    if project_in_domain.get("project_id", "UNKNOWN_ID") == requested_project_id:
-                        tenant_usage = self.get_tenant_usage(project_in_domain, requested_start_date)
-                        response = requests.Response()
-                        response._content = json.dumps(tenant_usage, default=str).encode("utf-8")
-                        return response
-        elif self.server_detail_all_tenants_string in url:
-            requested_project_id = url.split("=", 2)[2]
-            for domain_name, domain_content in self.dummy_values.items():
-                projects_in_domain = domain_content.get("projects", [])
-                for project_in_domain in projects_in_domain:
-                    if project_in_domain.get("project_id", "UNKNOWN_ID") == requested_project_id:
-                        server_details = self.get_server_details(project_in_domain)
-                        response = requests.Response()
-                        response._content = json.dumps(server_details, default=str).encode("utf-8")
-                        return response
-
-        response = requests.Response()
-        response._content = b'{}'
-        return response
+        if self.load_toml is not None:
+            self.load_toml()
+        tenant_usage_match = tenant_usage_url_pattern.search(url)
+        all_tenant_usages_match = all_tenant_usages_url_pattern.search(url)
+        server_detail_match = server_detail_url_pattern.search(url)
+        if all_tenant_usages_match:
+            return DummyResponse(self.get_all_tenant_usages(all_tenant_usages_match.group(1)))
+        elif tenant_usage_match:
+            requested_project_id, requested_start_date = tenant_usage_match.groups()
+            machines = self._project_machines.get(requested_project_id)
+            if machines is not None:
+                return DummyResponse(self.get_tenant_usage(requested_project_id, machines, requested_start_date))
+        elif server_detail_match:
+            requested_project_id = server_detail_match.group(1)
+            machines = self._project_machines.get(requested_project_id)
+            if machines is not None:
+                return DummyResponse(self.get_server_details(machines))
+
+        return DummyResponse({})
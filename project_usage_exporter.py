@@ -4,7 +4,6 @@ Query project usages from an openstack instance and provide it in a prometheus c
 format.
 Alternatively develop in local mode and emulate machines and projects.
 """
-import json
 from distutils.util import strtobool
 from argparse import (
     ArgumentParser,
@@ -13,28 +12,37 @@ from argparse import (
     ArgumentTypeError,
 )
 import logging
+import random
+import signal
 from typing import (
     Optional,
     TextIO,
     Set,
     Dict,
     Iterable,
+    List,
+    Tuple,
 )
-from time import sleep
-from datetime import datetime, timedelta
+from time import monotonic
+from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from os import getenv
 from dataclasses import dataclass
-from hashlib import sha256 as sha256func
+from functools import lru_cache
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+from urllib.parse import urlsplit, parse_qs, urlencode
 
-import toml
+import tomllib
 
 from dummy_cloud import DummyCloud
 
 import openstack  # type: ignore
 import prometheus_client  # type: ignore
+from prometheus_client.core import GaugeMetricFamily  # type: ignore
+from prometheus_client.samples import Sample  # type: ignore
 import keystoneauth1  # type: ignore
-import maya
-import ast
 import requests
 
 # enable logging for now
@@ -45,15 +53,22 @@ logger = logging.getLogger()
 project_labels = ["project_id", "project_name", "domain_name", "domain_id"]
 project_metrics = {
     # the key is the name of the value inside the API response, therefore do not change
-    # it
-    "total_vcpus_usage": prometheus_client.Gauge(
-        "project_vcpu_usage", "Total vcpu usage", labelnames=project_labels
-    ),
-    "total_memory_mb_usage": prometheus_client.Gauge(
-        "project_mb_usage", "Total MB usage", labelnames=project_labels
-    ),
+    # it, the value holds the name and documentation of the exported metric and the
+    # name of the matching value per server usage
+    "total_vcpus_usage": ("project_vcpu_usage", "Total vcpu usage", "vcpus"),
+    "total_memory_mb_usage": ("project_mb_usage", "Total MB usage", "memory_mb"),
 }
 HOURS_KEY = "hours"
+# the metric, the name of the matching value per server usage and whether the value
+# is in MB but weighted in GB
+instance_metrics = tuple(
+    (metric, instance_metric, metric == "total_memory_mb_usage")
+    for metric, (_, _, instance_metric) in project_metrics.items()
+)
+# the hours, start and metric values of a server usage in one call
+instance_values = itemgetter(
+    HOURS_KEY, "started_at", *(instance_metric for _, instance_metric, _ in instance_metrics)
+)
 
 __author__ = "tluettje"
 __license__ = "GNU AGPLv3"
@@ -67,6 +82,7 @@ simple_vm_project_id_env_var = "USAGE_EXPORTER_SIMPLE_VM_PROJECT_ID"
 simple_vm_project_name_tag_env_var = "USAGE_EXPORTER_SIMPLE_VM_PROJECT_TAG"
 verbosity_env_var = "USAGE_EXPORTER_VERBOSE_MODE"
 start_date_endpoint_env_var = "USAGE_EXPORTER_START_DATE_ENDPOINT"
+project_cache_ttl_env_var = "USAGE_EXPORTER_PROJECT_CACHE_TTL"
 
 # name of the domain whose projects to monitor
 project_domain_env_var = "USAGE_EXPORTER_PROJECT_DOMAINS"
@@ -83,14 +99,26 @@ default_dummy_file = "resources/dummy_cc.toml"
 
 default_dummy_weights_file = "resources/dummy_weights.toml"
 
+# the usages of all tenants are requested in pages of this many instances, paging
+# requires at least the given compute API microversion
+usage_page_limit = 1000
+usage_page_microversion = "2.40"
+
+# the update interval is prolonged by up to this fraction
+update_jitter = 0.1
+
+# seconds to wait for the weights endpoint
+weights_request_timeout = 10
 
-def sha256(content: str) -> str:
-    s = sha256func()
-    s.update(content.encode())
-    return s.hexdigest()
+# projects change rarely, only list them again after this many update intervals
+projects_refresh_frequency = 12
 
+# the usages are not updated anymore once this many updates have not been scraped,
+# well above the usual ratio of scrape and update interval
+unscraped_updates_limit = 20
 
-@dataclass(frozen=True)
+
+@dataclass(frozen=True, slots=True)
 class OpenstackProject:
     id: str
     name: str
@@ -112,17 +140,37 @@ class OpenstackExporter(_ExporterBase):
         domain_id: Optional[str] = None,
         simple_vm_project="",
         simple_vm_tag=None,
-        dummy_file: TextIO = None
+        dummy_file: TextIO = None,
+        projects_refresh_interval: float = 0,
     ) -> None:
-        self.domains = set(domains) if domains else None
+        self.domains = frozenset(domains) if domains else None
         self.domain_id = domain_id
         self.projects: Set[OpenstackProject] = set()
+        # ids of the projects, only rebuilt when the projects are collected
+        self._project_ids: Set[str] = set()
         self.stats_start = stats_start
+        # the start does not change, format it for the usage requests only once
+        self._stats_start_param = stats_start.strftime("%Y-%m-%dT%H:%M:%S.%f")
         self.simple_project_usages = None
         self.simple_vm_project = simple_vm_project
         self.simple_vm_tag = simple_vm_tag
         self.dummy_file = dummy_file
         self.weights = None
+        self._sorted_weights: Tuple[List[int], List[Dict[str, Tuple[list, list]]]] = ([], [])
+        self.usages: Dict[OpenstackProject, Dict[str, float]] = {}
+        # set once the usages have been scraped, updates nobody reads are paused
+        self.usages_scraped = Event()
+        # seconds after which the cached projects are listed again
+        self.projects_refresh_interval = projects_refresh_interval
+        self._projects_refreshed_at: Optional[float] = None
+        # ids of tenants with usages which are not exported, e.g. due to their domain
+        self._foreign_tenant_ids: Optional[Set[str]] = None
+        # simple vm tags of the instances of each simple vm project by instance id
+        self._simple_vm_tags: Dict[str, Dict[str, Optional[str]]] = {}
+        # lists the projects while the usages are requested
+        self._projects_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="ProjectsThread"
+        )
         if self.dummy_file is not None:
             self.cloud = DummyCloud(self.dummy_file, self.stats_start)
         else:
@@ -137,13 +185,31 @@ class OpenstackExporter(_ExporterBase):
                 raise ValueError
 
     def update(self) -> None:
-        self.projects = self.collect_projects()
-        logger.debug(f"Collected projects: {self.projects}")
-        self.usages = self.collect_usages(
-            start=self.stats_start.strftime("%Y-%m-%dT%H:%M:%S.%f")
-        )
-        logger.debug(f"Collected usages: {self.usages}")
-        self.set_metrics()
+        projects_future = None
+        if (
+            self._projects_refreshed_at is None
+            or monotonic() - self._projects_refreshed_at >= self.projects_refresh_interval
+        ):
+            # the projects do not depend on the usages, list them in the meantime
+            projects_future = self._projects_executor.submit(self.collect_projects)
+        tenant_usages = self.request_tenant_usages(start=self._stats_start_param)
+        if projects_future is not None:
+            self.set_projects(projects_future.result())
+        # keep exporting the previous usages if they could not be requested
+        if tenant_usages is not None:
+            self.usages = self.collect_usages(tenant_usages)
+            logger.debug("Collected usages: %s", self.usages)
+
+    def refresh_projects(self) -> None:
+        self.set_projects(self.collect_projects())
+
+    def set_projects(self, projects: Set[OpenstackProject]) -> None:
+        self.projects = projects
+        self._project_ids = {project.id for project in projects}
+        self._projects_refreshed_at = monotonic()
+        # the tags of the instances might have been changed in the meantime
+        self._simple_vm_tags = {}
+        logger.debug("Collected %d projects: %s", len(projects), projects)
 
     def update_weights(self, new_weights) -> None:
         if self.weights != new_weights:
@@ -152,64 +218,113 @@ class OpenstackExporter(_ExporterBase):
             logger.warning(f"Updated weights are empty, which should not happen. "
                            f"Please check configuration or activate debug mode.")
         self.weights = new_weights
+        # the timestamps and per timestamp the amounts of each metric in ascending order
+        # with their weights, so the weight of an instance can be bisected
+        timestamps = sorted(new_weights)
+        self._sorted_weights = (
+            timestamps,
+            [
+                {
+                    metric_tag: (
+                        sorted(metric_weights),
+                        [metric_weights[amount] for amount in sorted(metric_weights)],
+                    )
+                    for metric_tag, metric_weights in new_weights[timestamp].items()
+                }
+                for timestamp in timestamps
+            ],
+        )
 
-    def set_metrics(self) -> None:
-        for project, usage_values in self.usages.items():
-            for usage_name, gauge in project_metrics.items():
-                gauge.labels(
-                    project_id=project.id,
-                    project_name=project.name,
-                    domain_name=project.domain_name,
-                    domain_id=project.domain_id,
-                ).set(usage_values[usage_name])
-
-    def collect_usages(self, **query_args) -> Dict[OpenstackProject, Dict[str, float]]:
+    def request_tenant_usages(self, **query_args) -> Optional[Dict[str, dict]]:
         """
         :param query_args: Additional parameters for the `os-simple-tenant-usage`-url
+        :return: The usage of each tenant by its id or None if the usages could not be
+        requested
         """
-        query_params = "&".join(
-            "=".join((key, value)) for key, value in query_args.items()
-        )
-        project_usages: Dict[OpenstackProject, Dict[str, float]] = {}
-        for project in self.projects:
-            try:
+        url = usage_url(tuple(query_args.items()))
+        # the usages of all tenants at once instead of one request per project, page
+        # after page, a tenant's servers may be continued on the following page
+        tenant_usages: Dict[str, dict] = {}
+        marker = None
+        try:
+            while True:
+                page_url = url if marker is None else f"{url}&{urlencode({'marker': marker})}"
                 json_payload = self.cloud.compute.get(  # type: ignore
-                    f"/os-simple-tenant-usage/{project.id}?" + query_params
+                    page_url,
+                    microversion=usage_page_microversion,
                 ).json()
-                project_usage = json_payload["tenant_usage"]  # type: ignore
-                if not project_usage:
-                    logger.info(
-                        "Project %s has no existing projects (in the requested date "
-                        "range), skipping",
-                        project,
-                    )
-                    continue
-            except KeyError:
-                logger.error(
-                    "Received following invalid json payload: %s", json_payload
+                for tenant_usage in json_payload["tenant_usages"]:  # type: ignore
+                    known_usage = tenant_usages.get(tenant_usage["tenant_id"])
+                    if known_usage is None:
+                        tenant_usages[tenant_usage["tenant_id"]] = tenant_usage
+                    else:
+                        known_usage["server_usages"].extend(tenant_usage["server_usages"])
+                marker = next_page_marker(json_payload.get("tenant_usages_links", ()))
+                if marker is None:
+                    break
+        except KeyError:
+            logger.error(
+                "Received following invalid json payload: %s", json_payload
+            )
+            return None
+        except (
+            keystoneauth1.exceptions.ClientException,
+            openstack.exceptions.SDKException,
+            requests.RequestException,
+            ValueError,
+        ) as e:
+            # e.g. an unreachable or failing compute API or an invalid json payload,
+            # unexpected exceptions are logged with their traceback by the refresh loop
+            logger.warning("Could not request the usages: %s", e)
+            return None
+        return tenant_usages
+
+    def collect_usages(self, tenant_usages: Dict[str, dict]) -> Dict[OpenstackProject, Dict[str, float]]:
+        """
+        :param tenant_usages: The usage of each tenant by its id, see
+        :meth:`request_tenant_usages`
+        """
+        project_usages: Dict[OpenstackProject, Dict[str, float]] = {}
+        # without weights every instance is weighted with 1, neither the starts of the
+        # instances nor the weights have to be looked up
+        weighted = len(self._sorted_weights[0]) != 0
+        if not weighted:
+            logger.debug("Warning: no weights set!")
+        # bound once instead of for every instance and metric
+        get_instance_weight = self.get_instance_weight
+        unknown_tenant_ids = tenant_usages.keys() - self._project_ids
+        if (
+            self._foreign_tenant_ids is not None
+            and not unknown_tenant_ids <= self._foreign_tenant_ids
+        ):
+            # a tenant that has not been seen before, most likely a project created
+            # since the projects have been collected
+            logger.info("Received usages of unknown projects, collecting projects again")
+            self.refresh_projects()
+            unknown_tenant_ids = tenant_usages.keys() - self._project_ids
+        self._foreign_tenant_ids = unknown_tenant_ids
+        for project in self.projects:
+            project_usage = tenant_usages.get(project.id)
+            if not project_usage:
+                logger.debug(
+                    "Project %s has no existing projects (in the requested date "
+                    "range), skipping",
+                    project,
                 )
                 continue
-            except BaseException as e:
-                logger.exception(f"Received following exception:\n{e}")
-                continue
             if project.is_simple_vm_project:
                 if self.simple_vm_tag is None:
                     logger.error("The simple vm tag is not set, please set the simple vm metadata "
                                  "tag for simple vm tracking")
                 else:
-                    json_payload_metadata = self.cloud.compute.get(  # type: ignore
-                        f"/servers/detail?all_tenants=True&project_id=" + project.id
-                    ).json()
-                    instance_id_to_project_dict = {}
-                    for instance in json_payload_metadata['servers']:
-                        try:
-                            instance_id_to_project_dict[instance['id']] = instance['metadata'][self.simple_vm_tag]
-                        except KeyError as e:
-                            logger.debug(f"Could not get metadata for instance with id {instance['id']}"
-                                         f"Error message. {e}")
+                    instance_id_to_project_dict = self.simple_vm_instance_tags(
+                        project, project_usage["server_usages"]
+                    )
+                    # usages of the simple vm projects by their name
+                    simple_vm_usages: Dict[str, Dict[str, float]] = {}
+                    for simple_vm_project_name in set(instance_id_to_project_dict.values()):
+                        if simple_vm_project_name is None:
                             continue
-                    simple_vm_project_names = list(set(instance_id_to_project_dict.values()))
-                    for simple_vm_project_name in simple_vm_project_names:
                         svm_project = OpenstackProject(
                             id=project.id,
                             name=simple_vm_project_name,
@@ -217,67 +332,104 @@ class OpenstackExporter(_ExporterBase):
                             domain_id=project.domain_id,
                             is_simple_vm_project=True,
                         )
-                        project_usages[svm_project] = {}
-                        for metric in project_metrics:
-                            instance_metric = "_".join(metric.split("_")[1:len(metric.split("_")) - 1])
-                            total_usage = 0
-                            for instance in project_usage["server_usages"]:
-                                try:
-                                    if instance_id_to_project_dict[instance["instance_id"]] == simple_vm_project_name:
-                                        instance_hours = instance[HOURS_KEY]
-                                        if instance_hours > 0:
-                                            metric_amount = instance[instance_metric]
-                                            if metric == "total_memory_mb_usage":
-                                                metric_amount = int(metric_amount / 1024)
-                                            total_usage += (instance_hours * metric_amount) * self.get_instance_weight(
-                                                instance_metric, metric_amount, instance["started_at"])
-                                except KeyError as e:
-                                    logger.debug(f"Catching key error: {e}")
-                                    continue
-                            project_usages[svm_project][metric] = total_usage
-            else:
-                project_usages[project] = {}
-                for metric in project_metrics:
-                    instance_metric = "_".join(metric.split("_")[1:len(metric.split("_"))-1])
-                    total_usage = 0
+                        simple_vm_usages[simple_vm_project_name] = project_usages[svm_project] = dict.fromkeys(
+                            project_metrics, 0)
+                    # a single pass adding each server usage to its simple vm project
                     for instance in project_usage["server_usages"]:
-                        instance_hours = instance[HOURS_KEY]
-                        if instance_hours > 0:
-                            metric_amount = instance[instance_metric]
-                            if metric == "total_memory_mb_usage":
+                        try:
+                            simple_vm_project_name = instance_id_to_project_dict[instance["instance_id"]]
+                            instance_hours = instance[HOURS_KEY]
+                            started_at = instance["started_at"]
+                        except KeyError as e:
+                            logger.debug("Catching key error: %s", e)
+                            continue
+                        # instances without the simple vm tag belong to no simple vm project
+                        if simple_vm_project_name is None or instance_hours <= 0:
+                            continue
+                        usage_values = simple_vm_usages[simple_vm_project_name]
+                        if weighted:
+                            # parsed once for all metrics of the instance
+                            started_timestamp = parse_started_at(started_at)
+                        for metric, instance_metric, in_gb in instance_metrics:
+                            try:
+                                metric_amount = instance[instance_metric]
+                                if in_gb:
+                                    metric_amount = int(metric_amount / 1024)
+                                instance_usage = instance_hours * metric_amount
+                                if weighted:
+                                    instance_usage *= get_instance_weight(
+                                        instance_metric, metric_amount, started_timestamp)
+                                usage_values[metric] += instance_usage
+                            except KeyError as e:
+                                logger.debug("Catching key error: %s", e)
+                                continue
+            else:
+                usage_values = project_usages[project] = dict.fromkeys(project_metrics, 0)
+                for instance in project_usage["server_usages"]:
+                    instance_hours, started_at, *metric_amounts = instance_values(instance)
+                    if instance_hours > 0:
+                        if weighted:
+                            # parsed once for all metrics of the instance
+                            started_timestamp = parse_started_at(started_at)
+                        for (metric, instance_metric, in_gb), metric_amount in zip(instance_metrics, metric_amounts):
+                            if in_gb:
                                 metric_amount = int(metric_amount / 1024)
-                            total_usage += (instance_hours * metric_amount) * self.get_instance_weight(instance_metric, metric_amount, instance["started_at"])
-                    project_usages[project][metric] = total_usage
+                            instance_usage = instance_hours * metric_amount
+                            if weighted:
+                                instance_usage *= get_instance_weight(instance_metric, metric_amount, started_timestamp)
+                            usage_values[metric] += instance_usage
         return project_usages
 
-    def get_instance_weight(self, metric_tag, metric_amount, started_date):
-        instance_started_timestamp = datetime.strptime(started_date, "%Y-%m-%dT%H:%M:%S.%f").timestamp()
-        if self.weights is not None and len(self.weights) != 0:
-            sorted_timestamps = sorted(self.weights.keys())
-            min_timestamp = min(sorted_timestamps)
-            associated_weights = None
-            for timestamp in sorted_timestamps[::-1]:
-                if instance_started_timestamp >= timestamp or min_timestamp == timestamp:
-                    associated_weights = self.weights[timestamp]
-                    break
-            if associated_weights is not None:
-                metric_weights = associated_weights[metric_tag]
-                if len(metric_weights) == 0:
-                    logger.debug(f"No weights for {metric_tag}. Using 1.")
-                    return 1
-                sorted_keys = sorted(metric_weights.keys())
-                max_key = max(sorted_keys)
-                for key in sorted_keys:
-                    if metric_amount <= key or max_key == key:
-                        return metric_weights[key]
-                logger.debug(
-                    "Warning: The weight was set to 1 this should not happen though. Metric: %s, Weights: %s, Amount: %s"
-                    "", metric_tag, str(metric_weights), str(metric_amount))
-                return 1
-            else:
-                logger.debug("Warning: could not determine metric: %s for timestamp %s", self.weights,
-                             instance_started_timestamp)
+    def simple_vm_instance_tags(
+        self, project: OpenstackProject, server_usages: List[dict]
+    ) -> Dict[str, Optional[str]]:
+        """
+        :return: The simple vm tag of each instance in the server usages of the given
+        project by the id of the instance, None if the instance is not tagged. The
+        servers are only listed if an instance has not been seen before, the tags are
+        kept until the projects are collected again.
+        """
+        known_tags = self._simple_vm_tags.get(project.id, {})
+        instance_ids = {
+            instance["instance_id"] for instance in server_usages if "instance_id" in instance
+        }
+        if not instance_ids <= known_tags.keys():
+            known_tags = dict(known_tags)
+            json_payload_metadata = self.cloud.compute.get(  # type: ignore
+                servers_url(project.id)
+            ).json()
+            for instance in json_payload_metadata['servers']:
+                tag = instance.get('metadata', {}).get(self.simple_vm_tag)
+                if tag is None:
+                    logger.debug("Could not get the metadata tag %s for instance with id %s",
+                                 self.simple_vm_tag, instance['id'])
+                known_tags[instance['id']] = tag
+            # deleted instances are not listed anymore, do not list the servers for
+            # them again
+            for instance_id in instance_ids - known_tags.keys():
+                known_tags[instance_id] = None
+        # only the instances which still have usages are kept
+        instance_tags = {instance_id: known_tags[instance_id] for instance_id in instance_ids}
+        self._simple_vm_tags[project.id] = instance_tags
+        return instance_tags
+
+    def get_instance_weight(self, metric_tag, metric_amount, instance_started_timestamp: float):
+        """
+        :param instance_started_timestamp: POSIX timestamp of the instance's start
+        """
+        timestamps, sorted_weights = self._sorted_weights
+        if timestamps:
+            # the latest weights set before the instance started, the oldest ones otherwise
+            associated_weights = sorted_weights[
+                max(bisect_right(timestamps, instance_started_timestamp) - 1, 0)
+            ]
+            amounts, metric_weights = associated_weights[metric_tag]
+            if len(amounts) == 0:
+                logger.debug("No weights for %s. Using 1.", metric_tag)
                 return 1
+            # the weight of the smallest amount not below the metric amount, the weight
+            # of the largest amount otherwise
+            return metric_weights[min(bisect_left(amounts, metric_amount), len(amounts) - 1)]
         logger.debug("Warning: no weights set!")
         return 1
 
@@ -287,8 +439,12 @@ class OpenstackExporter(_ExporterBase):
             for project in self.cloud.list_projects(domain_id=self.domain_id):
                 add_project(project.id, project.name, self.domain_id, "UNKNOWN", self.simple_vm_project, projects)
         elif self.domains:
+            # a single request for the few domains instead of one per configured domain
+            domains_by_name_or_id = {}
+            for domain in self.cloud.list_domains():
+                domains_by_name_or_id[domain.id] = domains_by_name_or_id[domain.name] = domain
             for domain_name in self.domains:
-                domain = self.cloud.get_domain(name_or_id=domain_name)
+                domain = domains_by_name_or_id.get(domain_name)
                 if not domain:
                     logger.info(
                         "Could not detect any domain with name %s. Skipping",
@@ -298,12 +454,55 @@ class OpenstackExporter(_ExporterBase):
                 for project in self.cloud.list_projects(domain_id=domain.id):
                     add_project(project.id, project.name, self.domain_id, domain.name, self.simple_vm_project, projects)
         else:
+            # a single request for the few domains instead of one per project
+            domain_names = {domain.id: domain.name for domain in self.cloud.list_domains()}
             for project in self.cloud.list_projects():
-                domain_name = self.cloud.get_domain(name_or_id=project.domain_id).name
+                domain_name = domain_names.get(project.domain_id, "UNKNOWN")
                 add_project(project.id, project.name, project.domain_id, domain_name, self.simple_vm_project, projects)
         return projects
 
 
+class UsageCollector:
+    """
+    Provide the usages last collected by the exporter. The samples are assembled when
+    the metrics are scraped, projects without usages anymore are not exported.
+    """
+
+    def __init__(self, exporter: OpenstackExporter) -> None:
+        self.exporter = exporter
+        # the labels of each exported project, only built when the projects change
+        self._labels: Dict[OpenstackProject, Dict[str, str]] = {}
+
+    def describe(self):
+        for metric_name, documentation, _ in project_metrics.values():
+            yield GaugeMetricFamily(metric_name, documentation, labels=project_labels)
+
+    def collect(self):
+        # the usages are replaced as a whole on every update, never modified in place
+        usages = self.exporter.usages
+        self.exporter.usages_scraped.set()
+        labels = self._labels
+        if labels.keys() != usages.keys():
+            labels = self._labels = {
+                # label values in the order of `project_labels`, as strings like
+                # Gauge.labels() exported them
+                project: dict(zip(
+                    project_labels,
+                    map(str, (project.id, project.name, project.domain_name, project.domain_id)),
+                ))
+                for project in usages
+            }
+        for usage_name, (metric_name, documentation, _) in project_metrics.items():
+            metric_family = GaugeMetricFamily(
+                metric_name, documentation, labels=project_labels
+            )
+            metric_family.samples = [
+                Sample(metric_name, labels[project], usage_values[usage_name])
+                for project, usage_values in usages.items()
+            ]
+            yield metric_family
+
+
 def add_project(id, name, domain_id, domain_name, simple_vm_id, projects):
     is_simple_vm_project = False
     if id == simple_vm_id:
@@ -319,20 +518,65 @@ def add_project(id, name, domain_id, domain_name, simple_vm_id, projects):
     )
 
 
+@lru_cache(maxsize=8)
+def usage_url(query_items) -> str:
+    """
+    Assemble the `os-simple-tenant-usage`-url. The exporter passes the same start date
+    on every update, so the url is only built once.
+    :param query_items: Tuple of (key, value)-pairs
+    """
+    return "/os-simple-tenant-usage?" + urlencode(
+        {"detailed": "1", **dict(query_items), "limit": str(usage_page_limit)}, safe=":"
+    )
+
+
+@lru_cache(maxsize=2 ** 16)
+def parse_started_at(started_at: str) -> float:
+    """
+    :return: The POSIX timestamp of the start of an instance. The starts of the
+    running instances are the same on every update, so they are only parsed once.
+    """
+    return datetime.fromisoformat(started_at).timestamp()
+
+
+@lru_cache(maxsize=8)
+def servers_url(project_id: str) -> str:
+    """
+    Assemble the url listing the servers of the given project, only built once per
+    project.
+    """
+    return "/servers/detail?" + urlencode({"all_tenants": "True", "project_id": project_id})
+
+
+def next_page_marker(links) -> Optional[str]:
+    """
+    :return: The marker of the link to the next page or None if this is the last page.
+    """
+    for link in links:
+        if link.get("rel") == "next":
+            return parse_qs(urlsplit(link["href"]).query).get("marker", [None])[0]
+    return None
+
+
 def valid_date(s):
     try:
-        return maya.when(s).datetime()
+        date = datetime.fromisoformat(s)
     except ValueError:
         msg = f"Unrecognized date: '{s}'."
         raise ArgumentTypeError(msg)
+    # dates without timezone are considered UTC
+    if date.tzinfo is None:
+        return date.replace(tzinfo=timezone.utc)
+    return date.astimezone(timezone.utc)
 
 
 def get_dummy_weights(file):
+    """
+    :return: The weights of the dummy file, in the format of the weights endpoint's
+    json payload
+    """
     file.seek(0)
-    dummy_weights = toml.loads(file.read())
-    response = requests.Response()
-    response._content = json.dumps(dummy_weights["weights"], default=str).encode("utf-8")
-    return response
+    return tomllib.loads(file.read())["weights"]
 
 
 def convert_verbose():
@@ -349,6 +593,84 @@ def nullable_string(val):
     return val
 
 
+def refresh_loop(exporter: OpenstackExporter, args, stop: Event) -> None:
+    """
+    Periodically update the weights (if configured) and the usages of the exporter until
+    `stop` is set. The updates of the usages are paused after `unscraped_updates_limit`
+    updates without a scrape until the usages are scraped again.
+    Exceptions are logged but never end the loop.
+    """
+    # seconds between the weight updates, the weights are updated right away
+    weights_update_interval = args.weight_update_frequency * args.update_interval
+    weights_due = usages_due = monotonic()
+    # keeps the connection to the weights endpoint open between the updates
+    weights_session = requests.Session()
+    dummy_weights_path = getenv(dummy_weights_file_env_var)
+    # the weights are only converted and set again if their payload changed
+    last_weights_payload = None
+    # updates since the usages have been scraped the last time
+    unscraped_updates = 0
+    while True:
+        # the deadline does not drift by the time the updates take, but an update
+        # taking longer than the interval does not cause updates back to back.
+        # The jitter spreads the requests of multiple exporters started at the same time
+        usages_due = max(usages_due, monotonic()) + args.update_interval * (
+            1 + random.uniform(0, update_jitter)
+        )
+        if args.weight_update_endpoint != "" and monotonic() >= weights_due:
+            weights_due = monotonic() + weights_update_interval
+            try:
+                if args.dummy_weights:
+                    weights_payload = get_dummy_weights(args.dummy_weights)
+                elif dummy_weights_path:
+                    with open(dummy_weights_path) as file:
+                        weights_payload = get_dummy_weights(file)
+                else:
+                    weights_payload = weights_session.get(
+                        args.weight_update_endpoint, timeout=weights_request_timeout
+                    ).json()
+                if weights_payload == last_weights_payload:
+                    logger.debug("Credits weights are unchanged")
+                else:
+                    current_weights = {
+                        x['resource_set_timestamp']: {'memory_mb': {y['value']: y['weight'] for y in x['memory_mb']},
+                                                      'vcpus': {y['value']: y['weight'] for y in x['vcpus']}} for
+                        x in weights_payload}
+                    logger.debug("Updated credits weights, new weights: %s", current_weights)
+                    exporter.update_weights(current_weights)
+                    last_weights_payload = weights_payload
+            except Exception as e:
+                logger.exception(
+                    f"Received exception {e} while trying to update the credit weights, check if credit endpoint {args.weight_update_endpoint}"
+                    f" is accessible or contact the denbi team to check if the weights are set correctly. Traceback following."
+                )
+        if exporter.usages_scraped.is_set():
+            unscraped_updates = 0
+        # the usages are updated right away instead of after the first interval
+        if exporter.usages and unscraped_updates >= unscraped_updates_limit:
+            logger.debug(
+                "The usages have not been scraped for %d updates, skipping", unscraped_updates
+            )
+        else:
+            exporter.usages_scraped.clear()
+            unscraped_updates += 1
+            try:
+                exporter.update()
+            except Exception as e:
+                logger.exception(
+                    f"Received unexpected exception {e}. Traceback following."
+                )
+        remaining = usages_due - monotonic()
+        if remaining < 0:
+            logger.warning(
+                "Updating took %.1f seconds longer than the update interval, consider "
+                "increasing it",
+                -remaining,
+            )
+        if stop.wait(max(0.0, remaining)):
+            break
+
+
 def main():
     parser = ArgumentParser(
         epilog=f"{__license__} @ {__author__}",
@@ -439,7 +761,7 @@ def main():
         type=valid_date,
         default=getenv(start_date_env_var, datetime.today()),
         help=f"""Beginning time of stats (YYYY-MM-DD). If set the value of environment
-        variable ${start_date_env_var} is used. Uses maya for parsing.""",
+        variable ${start_date_env_var} is used. Expects ISO 8601, dates without timezone are considered UTC.""",
     )
     parser.add_argument(
         "-i",
@@ -450,6 +772,15 @@ def main():
         your openstack instance. Defaults to the value of environment variable
         ${update_interval_env_var} or 300 (in seconds)""",
     )
+    parser.add_argument(
+        "--project-cache-ttl",
+        type=int,
+        default=getenv(project_cache_ttl_env_var),
+        help=f"""Time after which the projects are listed again, projects appearing in the
+        usages are listed right away. Defaults to the value of environment variable
+        ${project_cache_ttl_env_var} or {projects_refresh_frequency} times the update interval
+        (in seconds)""",
+    )
     parser.add_argument(
         "-p", "--port", type=int, default=8080, help="Port to provide metrics on"
     )
@@ -467,83 +798,57 @@ def main():
         try:
             start_date_response = requests.get(args.start_date_endpoint)
             start_date_response = start_date_response.json()
-            args.start = maya.when(start_date_response[0]["start_date"]).datetime()
+            args.start = valid_date(start_date_response[0]["start_date"])
         except Exception as e:
             logger.exception(f"Exception when getting start date from endpoint. Exception message: {e}. "
                               f"Traceback following:\n")
             return 1
-    if args.dummy_data:
-        logger.info("Using dummy export with data from %s", args.dummy_data.name)
-        try:
-            exporter = OpenstackExporter(
-                domains=args.domain, stats_start=args.start, domain_id=args.domain_id,
-                simple_vm_project=args.simple_vm_id, simple_vm_tag=args.simple_vm_tag, dummy_file=args.dummy_data
-            )
-        except ValueError as e:
-            return 1
-    elif getenv(dummy_file_env_var):
-        logger.info("Using dummy export with data from %s", getenv(dummy_file_env_var))
-        # if the default dummy data have been used we need to open them, argparse
-        # hasn't done this for us since the default value has not been a string
-        try:
-            with open(getenv(dummy_file_env_var)) as file:
-                exporter = OpenstackExporter(
-                    domains=args.domain, stats_start=args.start, domain_id=args.domain_id,
-                    simple_vm_project=args.simple_vm_id, simple_vm_tag=args.simple_vm_tag, dummy_file=file
-                )
-        except ValueError as e:
-            return 1
-    else:
-        try:
+    # the arguments shared by the dummy and the regular exporter
+    exporter_args = dict(
+        domains=args.domain, stats_start=args.start, domain_id=args.domain_id,
+        simple_vm_project=args.simple_vm_id, simple_vm_tag=args.simple_vm_tag
+    )
+    dummy_file_path = getenv(dummy_file_env_var)
+    try:
+        if args.dummy_data:
+            logger.info("Using dummy export with data from %s", args.dummy_data.name)
+            exporter = OpenstackExporter(**exporter_args, dummy_file=args.dummy_data)
+        elif dummy_file_path:
+            logger.info("Using dummy export with data from %s", dummy_file_path)
+            # if the default dummy data have been used we need to open them, argparse
+            # hasn't done this for us since the default value has not been a string
+            with open(dummy_file_path) as file:
+                exporter = OpenstackExporter(**exporter_args, dummy_file=file)
+        else:
             logger.info("Using regular openstack exporter")
-            exporter = OpenstackExporter(
-                domains=args.domain, stats_start=args.start, domain_id=args.domain_id,
-                simple_vm_project=args.simple_vm_id, simple_vm_tag=args.simple_vm_tag
-            )
-        except ValueError as e:
-            return 1
-    logger.info(f"Beginning to serve metrics on port {args.port}")
-    prometheus_client.start_http_server(args.port)
-    laps = args.weight_update_frequency
+            exporter = OpenstackExporter(**exporter_args)
+    except ValueError:
+        return 1
+    prometheus_client.REGISTRY.register(UsageCollector(exporter))
+    if args.project_cache_ttl is not None:
+        exporter.projects_refresh_interval = args.project_cache_ttl
+    else:
+        exporter.projects_refresh_interval = projects_refresh_frequency * args.update_interval
     if args.dummy_weights or getenv(dummy_weights_file_env_var):
         args.weight_update_endpoint = "dummy-endpoint"
-    while True:
-        if args.weight_update_endpoint != "":
-            if laps >= args.weight_update_frequency:
-                try:
-                    if args.dummy_weights:
-                        weight_response = get_dummy_weights(args.dummy_weights)
-                    elif getenv(dummy_weights_file_env_var):
-                        with open(getenv(dummy_weights_file_env_var)) as file:
-                            weight_response = get_dummy_weights(file)
-                    else:
-                        weight_response = requests.get(args.weight_update_endpoint)
-                    current_weights = {
-                        x['resource_set_timestamp']: {'memory_mb': {y['value']: y['weight'] for y in x['memory_mb']},
-                                                      'vcpus': {y['value']: y['weight'] for y in x['vcpus']}} for
-                        x in weight_response.json()}
-                    logger.debug("Updated credits weights, new weights: " + str(current_weights))
-                    exporter.update_weights(current_weights)
-                except Exception as e:
-                    logger.exception(
-                        f"Received exception {e} while trying to update the credit weights, check if credit endpoint {args.weight_update_endpoint}"
-                        f" is accessible or contact the denbi team to check if the weights are set correctly. Traceback following."
-                    )
-                finally:
-                    laps = 0
-            else:
-                laps += 1
-        try:
-            sleep(args.update_interval)
-            exporter.update()
-        except KeyboardInterrupt:
-            logger.info("Received Ctrl-c, exiting.")
-            return 0
-        except Exception as e:
-            logger.exception(
-                f"Received unexpected exception {e}. Traceback following."
-            )
-            return 1
+    # collecting the usages may take a while, run it in the background so scrapes are
+    # always answered right away with the latest values
+    stop = Event()
+
+    def request_stop(signal_number, frame):
+        logger.info(f"Received {signal.Signals(signal_number).name}, exiting.")
+        stop.set()
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+    refresh_thread = Thread(
+        target=refresh_loop, args=(exporter, args, stop), name="RefreshThread", daemon=True
+    )
+    refresh_thread.start()
+    logger.info(f"Beginning to serve metrics on port {args.port}")
+    prometheus_client.start_http_server(args.port)
+    stop.wait()
+    return 0
 
 
 if __name__ == "__main__":